@@ -1,97 +1,493 @@
 import base64
-import fitz
-import pandas as pd
-import json
+import csv
+import hashlib
+import orjson
 import os
 import time
 import itertools
+import math
+import random
 import re
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 from pathlib import Path
-import google.generativeai as genai
 import tempfile
 from datetime import datetime
 from http.server import BaseHTTPRequestHandler
 import traceback
-from io import BytesIO
+from io import StringIO
+from urllib.parse import parse_qs, urlsplit
 
 # Load env variables from Vercel's environment
 API_KEYS_STR = os.environ.get("GEMINI_API_KEYS", "")
 if not API_KEYS_STR:
     raise ValueError("GEMINI_API_KEYS environment variable not set")
 API_KEYS = [key.strip() for key in API_KEYS_STR.split(',') if key.strip()]
-api_key_cycler = itertools.cycle(API_KEYS)
-current_api_key = next(api_key_cycler)
+# next() on itertools.count is atomic under the GIL, so worker threads can
+# share the round-robin counter without a lock.
+api_key_counter = itertools.count()
+clients_by_key = {}
+clients_lock = threading.Lock()
 
 GEMINI_MODEL = 'gemini-2.5-flash'
+BINARY_UPLOAD_PATH = '/extract-flashcards-binary'
+MAX_WORKERS = min(len(API_KEYS) * 2, 8)
+# Parallel page extraction is opt-in: Lambda-style hosts such as Vercel cannot
+# create process pools, and every worker receives its own copy of the PDF (and
+# re-imports this module under spawn/forkserver). Set PDF_WORKERS > 1 only on
+# hosts with /dev/shm and spare cores.
+PDF_WORKERS = max(int(os.environ.get("PDF_WORKERS", "1")), 1)
+PAGES_PER_PDF_WORKER = 16
+CHUNK_SIZE = 3000
+# Chunks end on sentence boundaries, so they need no overlap for context; any
+# overlap would be sent twice and yield duplicate flashcards at each boundary.
+CHUNK_OVERLAP = 0
+# Upper bound on Gemini calls per PDF; larger documents need a pageRange.
+MAX_CHUNKS = max(int(os.environ.get("MAX_CHUNKS", "40")), 1)
+# Cap on grown chunks: well inside the model's 1M-token context, but small
+# enough that the flashcards for one chunk fit into a single response. Never
+# below CHUNK_SIZE, so chunks always have room beyond CHUNK_OVERLAP.
+MAX_CHUNK_SIZE = max(int(os.environ.get("MAX_CHUNK_SIZE", "60000")), CHUNK_SIZE)
+BATCH_SIZE = 4
+BATCH_MAX_TOKENS = 16000
+API_ATTEMPTS = 3
+RATE_LIMIT_BACKOFF = 1
+SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+PAGE_RANGE_RE = re.compile(r'\s*(\d+)\s*(?:-\s*(\d+))?\s*(?:,|$)')
+JSON_FENCE_RE = re.compile(r'```json\s*(\[.*?\])\s*```', re.DOTALL)
+RESPONSE_CACHE_SIZE = int(os.environ.get("GEMINI_RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_DIR = os.environ.get(
+    "GEMINI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gemini-cache")
+)
+RESPONSE_CACHE_TTL = 86400
 
-def extract_text_from_pdf_bytes(pdf_bytes):
+# Exact-match cache of parsed Gemini responses, keyed by prompt + chunk + model.
+# The in-process LRU sits in front of a disk cache that survives restarts; the
+# disk cache is opened on first use so cold starts do not touch SQLite.
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+disk_cache = None
+disk_cache_lock = threading.Lock()
+
+def next_api_key():
+    return API_KEYS[next(api_key_counter) % len(API_KEYS)]
+
+# fitz, diskcache and the Gemini client library are imported where they are used so that cold
+# starts rejecting a request early do not pay for loading them.
+
+class PageRangeError(ValueError):
+    pass
+
+# Parses "1-3, 5, 9-12" into sorted, merged 1-based inclusive intervals.
+def parse_page_ranges(page_range_str):
+    if page_range_str is None:
+        return []
+    if isinstance(page_range_str, int) and not isinstance(page_range_str, bool):
+        page_range_str = str(page_range_str)
+    if not isinstance(page_range_str, str):
+        raise PageRangeError(f"pageRange must be a string like '1-3, 5', got {page_range_str!r}")
+    intervals = []
+    pos = 0
+    while pos < len(page_range_str):
+        match = PAGE_RANGE_RE.match(page_range_str, pos)
+        if not match or match.end() == pos:
+            raise PageRangeError(f"Invalid page range: {page_range_str!r}")
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        if start < 1 or end < start:
+            raise PageRangeError(f"Invalid page range: {page_range_str!r}")
+        intervals.append((start, end))
+        pos = match.end()
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def extract_pages_text(pdf_bytes, page_ranges):
+    import fitz
+
+    # Plain text only, without layout sorting. TEXT_PRESERVE_IMAGES is left out
+    # so MuPDF does not decode image blocks while walking the page.
+    text_flags = (
+        fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+    )
     document = fitz.open(stream=pdf_bytes, filetype="pdf")
-    text = ""
-    for page_num in range(len(document)):
+    parts = [None] * sum(len(pages) for pages in page_ranges)
+    page_nums = itertools.chain.from_iterable(page_ranges)
+    for i, page_num in enumerate(page_nums):
         page = document.load_page(page_num)
-        text += page.get_text()
+        parts[i] = page.get_text("text", flags=text_flags, sort=False)
     document.close()
-    return text
+    return "".join(parts)
 
-def call_gemini_api_for_extraction(text_chunk, prompt_text):
-    global current_api_key, api_key_cycler
-    prompt = f"{prompt_text}\n---\n{text_chunk}\n---"
+def extract_text_from_pdf_bytes(pdf_bytes, page_intervals=None):
+    import fitz
+
+    document = fitz.open(stream=pdf_bytes, filetype="pdf")
+    page_count = len(document)
+    document.close()
+
+    # Clamp the 1-based intervals to the document and turn them into 0-based ranges.
+    page_ranges = [
+        range(max(start, 1) - 1, min(end, page_count))
+        for start, end in (page_intervals or [(1, page_count)])
+    ]
+    page_ranges = [pages for pages in page_ranges if pages]
+    if page_intervals and not page_ranges:
+        raise PageRangeError(f"Page range selects no pages; the PDF has {page_count} pages")
+    selected_count = sum(len(pages) for pages in page_ranges)
+
+    workers = min(PDF_WORKERS, selected_count // PAGES_PER_PDF_WORKER)
+    if workers < 2:
+        return extract_pages_text(pdf_bytes, page_ranges)
+
+    # MuPDF documents are not thread-safe and fitz holds the GIL, so split the
+    # selected pages into one group of range slices per worker process; each
+    # task then gets its own document and a single copy of pdf_bytes.
+    step = math.ceil(selected_count / workers)
+    worker_ranges = []
+    group, group_len = [], 0
+    for pages in page_ranges:
+        while pages:
+            piece, pages = pages[:step - group_len], pages[step - group_len:]
+            group.append(piece)
+            group_len += len(piece)
+            if group_len == step:
+                worker_ranges.append(group)
+                group, group_len = [], 0
+    if group:
+        worker_ranges.append(group)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            texts = list(executor.map(extract_pages_text, itertools.repeat(pdf_bytes), worker_ranges))
+    except (OSError, NotImplementedError, BrokenProcessPool):
+        # Serverless runtimes without /dev/shm cannot create process pools.
+        return extract_pages_text(pdf_bytes, page_ranges)
+    return "".join(texts)
+
+def response_cache_key(text_chunk, prompt_text):
+    payload = orjson.dumps(
+        {"prompt": prompt_text, "chunk": text_chunk, "model": GEMINI_MODEL},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def get_disk_cache():
+    global disk_cache
+    import diskcache
+
+    with disk_cache_lock:
+        if disk_cache is None:
+            try:
+                disk_cache = diskcache.Cache(RESPONSE_CACHE_DIR, size_limit=1 << 30)
+            except (diskcache.Timeout, OSError, sqlite3.Error) as e:
+                # Without a writable cache dir, keep going with the in-process LRU only.
+                print(f"Disk cache disabled: {e}")
+                disk_cache = False
+        return disk_cache or None
+
+def get_cached_response(key):
+    with response_cache_lock:
+        data = response_cache.get(key)
+        if data is not None:
+            response_cache.move_to_end(key)
+            return data
+    data = None
+    cache = get_disk_cache()
+    if cache:
+        import diskcache
+
+        try:
+            data = cache.get(key)
+        except (diskcache.Timeout, OSError, sqlite3.Error) as e:
+            print(f"Disk cache read failed: {e}")
+    if data is not None:
+        cache_response(key, data, persist=False)
+    return data
+
+def cache_response(key, data, persist=True):
+    cache = get_disk_cache() if persist else None
+    if cache:
+        import diskcache
+
+        try:
+            cache.set(key, data, expire=RESPONSE_CACHE_TTL)
+        except (diskcache.Timeout, OSError, sqlite3.Error) as e:
+            # A busy or broken disk cache must not fail a successful Gemini reply.
+            print(f"Disk cache write failed: {e}")
+    with response_cache_lock:
+        response_cache[key] = data
+        response_cache.move_to_end(key)
+        while len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+
+def get_client(api_key):
+    from google.ai import generativelanguage as glm
+
+    # One client per key, built with its own credentials rather than through
+    # genai.configure()'s process-wide default client.
+    with clients_lock:
+        client = clients_by_key.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            clients_by_key[api_key] = client
+        return client
+
+class MalformedReplyError(ValueError):
+    pass
 
-    for i in range(3):
+# Returns the parsed JSON list, or None once every attempt failed on the API
+# side (rate limiting, transport). Raises MalformedReplyError when the last
+# reply was not parseable JSON, or on the first such reply if retry_malformed
+# is off.
+def call_gemini_api(prompt, api_key=None, retry_malformed=True):
+    from google.api_core import exceptions as google_exceptions
+
+    api_key = api_key or next_api_key()
+    malformed = None
+    for i in range(API_ATTEMPTS):
         try:
-            genai.configure(api_key=current_api_key)
-            model = genai.GenerativeModel(GEMINI_MODEL)
-            response = model.generate_content(
-                contents=[{"role": "user", "parts": [{"text": prompt}]}]
+            response = get_client(api_key).generate_content(
+                request={
+                    "model": f"models/{GEMINI_MODEL}",
+                    "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                }
             )
-            raw_text = response.text.strip()
+            raw_text = "".join(part.text for part in response.candidates[0].content.parts).strip()
+        except google_exceptions.ResourceExhausted:
+            # Rate limited (HTTP 429): back off with jitter before the next key.
+            malformed = None
+            api_key = next_api_key()
+            if i < API_ATTEMPTS - 1:
+                time.sleep(RATE_LIMIT_BACKOFF * 2 ** i * random.uniform(0.8, 1.2))
+            continue
+        except Exception as e:
+            malformed = None
+            api_key = next_api_key()
+            continue
 
-            match = re.search(r'```json\s*(\[.*?\])\s*```', raw_text, re.DOTALL)
+        if raw_text.startswith('['):
+            json_str = raw_text
+        else:
+            match = JSON_FENCE_RE.search(raw_text)
             json_str = match.group(1) if match else raw_text
-            extracted_data = json.loads(json_str)
-            return extracted_data if isinstance(extracted_data, list) else []
-        except Exception as e:
-            current_api_key = next(api_key_cycler)
-            time.sleep(1)
-    return []
-
-def process_text_in_chunks(full_text, prompt_text, chunk_size=3000):
-    all_data = []
-    for i in range(0, len(full_text), chunk_size):
-        chunk = full_text[i:i + chunk_size]
-        chunk_data = call_gemini_api_for_extraction(chunk, prompt_text)
-        all_data.extend(chunk_data)
-    return all_data
+        try:
+            extracted_data = orjson.loads(json_str)
+        except orjson.JSONDecodeError as e:
+            malformed = MalformedReplyError(f"Unparseable Gemini reply: {e}")
+            if not retry_malformed:
+                raise malformed
+            api_key = next_api_key()
+            continue
+        return extracted_data if isinstance(extracted_data, list) else []
+    if malformed is not None:
+        raise malformed
+    return None
 
-def handler(request):
+def call_gemini_api_for_extraction(text_chunk, prompt_text, api_key=None):
+    cache_key = response_cache_key(text_chunk, prompt_text)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        return cached
+
+    prompt = f"{prompt_text}\n---\n{text_chunk}\n---"
     try:
-        body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
-        pdf_base64 = body.get("pdfContent")
-        prompt_text = body.get("promptText", "Default prompt")
-        output_filename = body.get("outputFilename", f"flashcards_{int(time.time())}")
+        extracted_data = call_gemini_api(prompt, api_key) or []
+    except MalformedReplyError:
+        extracted_data = []
+    # Empty results are indistinguishable from failures, so only cache hits.
+    if extracted_data:
+        cache_response(cache_key, extracted_data)
+    return extracted_data
 
-        if not pdf_base64:
-            return (400, {"error": "No PDF content provided"})
+# Extracts several chunks with one request; returns one result list per chunk.
+def call_gemini_api_for_batch(text_chunks, prompt_text, api_key=None):
+    results = [get_cached_response(response_cache_key(chunk, prompt_text)) for chunk in text_chunks]
+    missing = [i for i, data in enumerate(results) if data is None]
+    if len(missing) == 1:
+        i = missing[0]
+        results[i] = call_gemini_api_for_extraction(text_chunks[i], prompt_text, api_key)
+    elif missing:
+        sections = "\n".join(
+            f"=== CHUNK {n} ===\n{text_chunks[i]}" for n, i in enumerate(missing)
+        )
+        prompt = (
+            f"{prompt_text}\n---\n"
+            f"The text below is split into {len(missing)} chunks, each introduced by a "
+            f"'=== CHUNK n ===' line. Apply the instructions above to every chunk separately "
+            f"and return one JSON array holding {len(missing)} arrays, the results for each "
+            f"chunk in chunk order.\n---\n{sections}\n---"
+        )
+        try:
+            # An unparseable batch reply is most likely truncated, and sending
+            # the same batch again cannot fix that, so don't retry it.
+            batch_data = call_gemini_api(prompt, api_key, retry_malformed=False)
+        except MalformedReplyError:
+            batch_data = []
+        if batch_data is None:
+            # Every attempt failed on the API side (e.g. rate limited);
+            # re-sending the chunks one by one would only add load.
+            for i in missing:
+                results[i] = []
+        elif (
+            len(batch_data) == len(missing)
+            and all(isinstance(data, list) for data in batch_data)
+        ):
+            for i, data in zip(missing, batch_data):
+                results[i] = data
+                if data:
+                    cache_response(response_cache_key(text_chunks[i], prompt_text), data)
+        else:
+            # Truncated or wrongly shaped batch reply: redo the chunks one at a time.
+            for i in missing:
+                results[i] = call_gemini_api_for_extraction(text_chunks[i], prompt_text, api_key)
+    return results
+
+def split_into_sentences(full_text, max_len):
+    sentences = []
+    start = 0
+    ends = [m.end() for m in SENTENCE_END_RE.finditer(full_text)]
+    for end in ends + [len(full_text)]:
+        # Hard-split run-on text that would not fit in a chunk by itself.
+        for i in range(start, end, max_len):
+            sentences.append(full_text[i:min(i + max_len, end)])
+        start = end
+    return sentences
+
+def split_text_into_chunks(full_text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    chunks = []
+    current, current_len = [], 0
+    for sentence in split_into_sentences(full_text, chunk_size - overlap):
+        if current and current_len + len(sentence) > chunk_size:
+            chunks.append("".join(current))
+            # Carry the trailing sentences (up to `overlap` chars) into the next chunk.
+            carried, carried_len = [], 0
+            for prev in reversed(current):
+                if carried_len + len(prev) > overlap:
+                    break
+                carried.insert(0, prev)
+                carried_len += len(prev)
+            current, current_len = carried, carried_len
+        current.append(sentence)
+        current_len += len(sentence)
+    if current:
+        chunks.append("".join(current))
+    return chunks
 
-        pdf_bytes = base64.b64decode(pdf_base64)
-        pdf_text = extract_text_from_pdf_bytes(pdf_bytes)
-        flashcards = process_text_in_chunks(pdf_text, prompt_text)
+def batch_chunks(chunks, batch_size=BATCH_SIZE, max_tokens=BATCH_MAX_TOKENS):
+    batches = []
+    current, current_tokens = [], 0
+    for chunk in chunks:
+        # Rough budget of ~4 characters per token; oversized chunks go alone.
+        tokens = len(chunk) // 4
+        if current and (len(current) >= batch_size or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(chunk)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
 
-        # Save to CSV
-        temp_dir = tempfile.gettempdir()
-        csv_path = os.path.join(temp_dir, f"{output_filename}.csv")
-        pd.DataFrame(flashcards).to_csv(csv_path, index=False)
+def process_text_in_chunks(chunks, prompt_text):
+    # Batches are independent network-bound calls; executor.map keeps results
+    # in submission order.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(
+            lambda batch: call_gemini_api_for_batch(batch, prompt_text, next_api_key()),
+            batch_chunks(chunks),
+        )
+        return [card for batch_data in results for chunk_data in batch_data for card in chunk_data]
 
-        # For now, return CSV content as base64 (can later switch to Supabase Storage)
-        with open(csv_path, "rb") as f:
-            csv_base64 = base64.b64encode(f.read()).decode()
+def plan_chunk_size(text_len):
+    # Grow chunks (up to MAX_CHUNK_SIZE) so long documents aim for MAX_CHUNKS;
+    # sentence packing can still produce more, so callers check the real count.
+    step = max(CHUNK_SIZE - CHUNK_OVERLAP, math.ceil(text_len / MAX_CHUNKS))
+    return min(step + CHUNK_OVERLAP, MAX_CHUNK_SIZE)
 
-        return (200, {
-            "flashcardsCount": len(flashcards),
-            "fileName": f"{output_filename}.csv",
-            "fileContentBase64": csv_base64
+def extract_flashcards(pdf_bytes, prompt_text, output_filename, page_intervals=None):
+    try:
+        pdf_text = extract_text_from_pdf_bytes(pdf_bytes, page_intervals)
+    except PageRangeError as e:
+        return (400, {"error": str(e)})
+    chunk_size = plan_chunk_size(len(pdf_text))
+    chunks = split_text_into_chunks(pdf_text, chunk_size)
+    if len(chunks) > MAX_CHUNKS:
+        print(f"Rejecting PDF: {len(chunks)} chunks of {chunk_size} chars exceeds {MAX_CHUNKS}")
+        return (413, {
+            "error": "PDF too large",
+            "chunkCount": len(chunks),
+            "maxChunks": MAX_CHUNKS,
+            "estimatedTokens": len(pdf_text) // 4,
         })
 
+    flashcards = process_text_in_chunks(chunks, prompt_text)
+
+    # Build the CSV in memory and return it as base64 (can later switch to Supabase Storage)
+    csv_base64 = base64.b64encode(flashcards_to_csv(flashcards).encode()).decode()
+
+    return (200, {
+        "flashcardsCount": len(flashcards),
+        "fileName": f"{output_filename}.csv",
+        "fileContentBase64": csv_base64
+    })
+
+def flashcards_to_csv(flashcards):
+    # Like pd.DataFrame(flashcards): list-shaped cards become positional
+    # columns 0..n-1 and scalar cards a single column 0.
+    rows = [
+        card if isinstance(card, dict)
+        else dict(enumerate(card)) if isinstance(card, (list, tuple))
+        else {0: card}
+        for card in flashcards
+    ]
+    # Columns are the union of keys in first-seen order, as pandas did.
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+def read_pdf_request(request):
+    url = urlsplit(request.path)
+    content_length = int(request.headers['Content-Length'])
+    content_type = request.headers.get('Content-Type', '')
+
+    # POST /extract-flashcards-binary (or any application/pdf body) carries the
+    # raw PDF, with promptText/outputFilename/pageRange in the query string.
+    if url.path.rstrip('/').endswith(BINARY_UPLOAD_PATH) or content_type.startswith('application/pdf'):
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        return request.rfile.read(content_length), params
+
+    body = orjson.loads(request.rfile.read(content_length))
+    # Pop the base64 string so only the decoded bytes outlive this function.
+    pdf_base64 = body.pop("pdfContent", None)
+    return (base64.b64decode(pdf_base64) if pdf_base64 else None), body
+
+def handler(request):
+    try:
+        pdf_bytes, params = read_pdf_request(request)
+        prompt_text = params.get("promptText", "Default prompt")
+        output_filename = params.get("outputFilename", f"flashcards_{int(time.time())}")
+
+        if not pdf_bytes:
+            return (400, {"error": "No PDF content provided"})
+
+        try:
+            page_intervals = parse_page_ranges(params.get("pageRange"))
+        except PageRangeError as e:
+            return (400, {"error": str(e)})
+
+        return extract_flashcards(pdf_bytes, prompt_text, output_filename, page_intervals)
+
     except Exception as e:
         traceback.print_exc()
         return (500, {"error": str(e)})
@@ -101,4 +497,4 @@ def handler_main(request, response):
     status, data = handler(request)
     response.status_code = status
     response.headers["Content-Type"] = "application/json"
-    response.write(json.dumps(data))
+    response.write(orjson.dumps(data).decode())